@@ -1,6 +1,8 @@
+import os
 import tensorflow as tf
 import numpy as np
 from tensorflow.keras.layers import (
+    Activation,
     Dense,
     Conv1D,
     MaxPool1D,
@@ -36,10 +38,12 @@ class vanilla_decoder(tf.keras.layers.Layer):
             units=intermediate_dim, activation=relu, kernel_initializer="he_uniform"
         )
         self.output_layer = Dense(units=original_dim, activation=sigmoid)
+        # keep the reconstruction, and so the loss, in float32 under mixed precision
+        self.output_cast = Activation("linear", dtype="float32")
 
     def call(self, code):
         x = self.hidden_layer(code)
-        return self.output_layer(x)
+        return self.output_cast(self.output_layer(x))
 
 
 class vanilla_autoencoder(tf.keras.Model):
@@ -93,10 +97,11 @@ class convolutional_decoder(tf.keras.layers.Layer):
             ]
         )
         self.output_layer = Conv1D(1, 5, 1, activation="sigmoid", padding="same")
+        self.output_cast = Activation("linear", dtype="float32")
 
     def call(self, code):
         x = self.hidden_layer(code)
-        return self.output_layer(x)
+        return self.output_cast(self.output_layer(x))
 
 
 class convolutional_autoencoder(tf.keras.Model):
@@ -119,9 +124,9 @@ class Sampling(tf.keras.layers.Layer):
 
     def call(self, inputs):
         z_mean, z_log_var = inputs
-        batch = tf.shape(z_mean)[0]
-        dim = tf.shape(z_mean)[1]
-        epsilon = tf.keras.backend.random_normal(shape=(batch, dim, 1))
+        epsilon = tf.keras.backend.random_normal(
+            shape=tf.shape(z_mean), dtype=z_mean.dtype
+        )
         output = z_mean + tf.math.multiply(tf.exp(0.5 * z_log_var), epsilon)
         return output
 
@@ -151,10 +156,11 @@ class variational_decoder(tf.keras.layers.Layer):
             units=intermediate_dim, activation=relu, kernel_initializer="he_uniform"
         )
         self.output_layer = Dense(units=original_dim, activation=sigmoid)
+        self.output_cast = Activation("linear", dtype="float32")
 
     def call(self, inputs):
         x = self.hidden_layer(inputs)
-        return self.output_layer(x)
+        return self.output_cast(self.output_layer(x))
 
 
 class variational_autoencoder(tf.keras.Model):
@@ -168,3 +174,28 @@ class variational_autoencoder(tf.keras.Model):
         z_mean, z_var, z = self.encoder(inputs)
         reconstructed = self.decoder(z)
         return reconstructed
+
+
+class CustomModelSaver(tf.keras.callbacks.Callback):
+    def __init__(self, checkpoint_dir):
+        super(CustomModelSaver, self).__init__()
+        self.checkpoint_dir = checkpoint_dir
+
+    def on_epoch_end(self, epoch, logs=None):
+        # save_weights on a compiled model also writes the optimizer slots, keep
+        # only the layers under the same encoder/ and decoder/ keys instead
+        save_name = "epoch_{}".format(epoch)
+        layers = tf.train.Checkpoint(
+            encoder=self.model.encoder, decoder=self.model.decoder
+        )
+        layers.write(self.checkpoint_dir + os.sep + save_name)
+
+    def on_train_end(self, logs=None):
+        tf.keras.models.save_model(
+            self.model, self.checkpoint_dir + os.sep + "final", save_format="tf"
+        )
+
+
+def autoencoder_loss_fn(input_features, decoded):
+    decode_error = tf.reduce_mean(tf.math.squared_difference(decoded, input_features))
+    return decode_error
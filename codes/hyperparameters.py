@@ -22,6 +22,11 @@ Batch size
 """
 batch_size = 4
 
+"""
+Number of training batches run per compiled call
+"""
+steps_per_execution = 50
+
 
 """
 encode dimension
@@ -12,25 +12,8 @@ from sklearn.exceptions import DataConversionWarning
 warnings.filterwarnings(action="ignore", category=DataConversionWarning)
 
 
-import tensorflow as tf
-
 import numpy as np
 import hyperparameters as hp
-from autoencoders import (
-    vanilla_autoencoder,
-    variational_autoencoder,
-    convolutional_autoencoder,
-)
-from classifiers import vanilla_classifier
-from xgboost import XGBClassifier
-from sklearn.model_selection import train_test_split, StratifiedKFold, GridSearchCV
-from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
-from sklearn.metrics import roc_curve, roc_auc_score, plot_roc_curve
-
-import matplotlib.pyplot as plt
-import matplotlib
 from utils import *
 
 
@@ -83,30 +66,80 @@ def parse_args():
     return parser.parse_args()
 
 
-class CustomModelSaver(tf.keras.callbacks.Callback):
-    def __init__(self, checkpoint_dir):
-        super(CustomModelSaver, self).__init__()
-        self.checkpoint_dir = checkpoint_dir
-
-    def on_epoch_end(self, epoch, logs=None):
-        save_name = "epoch_{}".format(epoch)
-        tf.keras.models.save_model(
-            self.model, self.checkpoint_dir + os.sep + save_name, save_format="tf"
+def encode_omics(autoencoder, omics_features):
+    """ Encode omics features, reusing the saved encoding of a loaded checkpoint. """
+
+    # after --train-autoencoder the weights in memory no longer match the
+    # loaded checkpoint, so its cached encoding must not be used or overwritten
+    cache_path = None
+    if ARGS.load_autoencoder is not None and not ARGS.train_autoencoder:
+        cache_path = os.path.join(
+            ".cache",
+            "omics_{}_{}_{}_{}.npy".format(
+                ARGS.autoencoder_model,
+                ARGS.merged_data.split("/")[-1][:-4],
+                # a regenerated merged csv keeps its name but not its mtime
+                os.stat(ARGS.merged_data).st_mtime_ns,
+                checkpoint_digest(ARGS.load_autoencoder),
+            ),
         )
+        if os.path.exists(cache_path):
+            print("===== load omics encoding from {} =====".format(cache_path))
+            return np.load(cache_path).reshape(-1, hp.latent_dim)
+
+    # only the Conv1D encoder expects a (patients, 1, features) input
+    if ARGS.autoencoder_model == "convolutional":
+        omics_features = omics_features[:, np.newaxis, :]
+    if ARGS.autoencoder_model == "variational":
+        encoded = autoencoder.encoder(omics_features)[-1]
+    else:
+        encoded = autoencoder.encoder(omics_features)
+    # a mixed precision encoder returns float16 codes
+    encoded = encoded.numpy().astype(np.float32).reshape(-1, hp.latent_dim)
 
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        save_npy(cache_path, encoded)
+    return encoded
 
-def autoencoder_loss_fn(model, input_features):
-    decode_error = tf.losses.mean_squared_error(model(input_features), input_features)
-    return decode_error
 
+def fit_classifier(estimator, X_train, y_train):
+    estimator.fit(X_train, y_train)
+    return estimator
 
-def autoencoder_train(loss_fn, model, optimizer, input_features, train_loss):
-    with tf.GradientTape() as tape:
-        loss = loss_fn(model, input_features)
-        gradients = tape.gradient(loss, model.trainable_variables)
-        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
 
-        train_loss(loss)
+def rs_cv_fit_score(estimator, params, X_train, y_train):
+    """ Successive halving search over params, scored by ROC AUC. """
+
+    from sklearn.experimental import enable_halving_search_cv  # noqa
+    from sklearn.model_selection import HalvingRandomSearchCV, StratifiedKFold
+
+    search = HalvingRandomSearchCV(
+        estimator,
+        params,
+        factor=3,
+        cv=StratifiedKFold(n_splits=4, shuffle=True, random_state=42),
+        scoring="roc_auc",
+        n_jobs=-1,
+        random_state=42,
+    )
+    return search.fit(X_train, y_train)
+
+
+def xgb_device_params(gpus, use_autoencoder):
+    """ XGBoost settings that build the histograms on the GPU if there is one. """
+
+    # runs that did not import tensorflow ask the driver instead
+    use_gpu = bool(gpus) if use_autoencoder else has_cuda_gpu()
+    if use_gpu:
+        return dict(tree_method="gpu_hist", predictor="gpu_predictor", n_jobs=1)
+    return dict(tree_method="hist", n_jobs=-1)
+
+
+def classifier_scores(estimator, X_test):
+    if hasattr(estimator, "predict_proba"):
+        return estimator.predict_proba(X_test)[:, 1]
+    return estimator.decision_function(X_test)
 
 
 """
@@ -135,14 +168,6 @@ def main():
     time_now = datetime.now()
     timestamp = time_now.strftime("%m%d%y-%H%M%S")
 
-    gpus = tf.config.list_physical_devices("GPU")
-    if gpus:
-        try:
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as e:
-            print(e)
-
     checkpoint_path = (
         "./output/checkpoints"
         + os.sep
@@ -170,79 +195,120 @@ def main():
         os.makedirs(checkpoint_path)
         os.makedirs(logs_path)
 
-    omics_data = pd.read_csv(ARGS.omics_data, index_col=0).T.astype("float32")
-    (num_patients, num_features) = omics_data.shape
-    print(
-        "{} contains {} patients with {} features".format(
-            ARGS.omics_data.split("/")[-1], num_patients, num_features
-        )
+    # biomed and raw omics classifiers never use the autoencoder, so tensorflow
+    # is only imported for the runs that do
+    use_autoencoder = ARGS.train_autoencoder or (
+        ARGS.train_classifier and ARGS.classifier_data in ("merged", "embed_omics")
     )
-
-    if ARGS.autoencoder_model == "vanilla":
-        autoencoder = vanilla_autoencoder(
-            latent_dim=hp.latent_dim,
-            intermediate_dim=hp.intermediate_dim,
-            original_dim=num_features,
-        )
-    elif ARGS.autoencoder_model == "convolutional":
-        autoencoder = convolutional_autoencoder(
-            latent_dim=hp.latent_dim, original_dim=num_features,
+    gpus = []
+    if use_autoencoder:
+        import tensorflow as tf
+        from autoencoders import (
+            vanilla_autoencoder,
+            variational_autoencoder,
+            convolutional_autoencoder,
+            autoencoder_loss_fn,
+            CustomModelSaver,
         )
-    elif ARGS.autoencoder_model == "variational":
-        autoencoder = variational_autoencoder(
-            original_dim=num_features,
-            intermediate_dim=hp.intermediate_dim,
-            latent_dim=hp.latent_dim,
+
+        gpus = tf.config.list_physical_devices("GPU")
+        if gpus:
+            try:
+                for gpu in gpus:
+                    tf.config.experimental.set_memory_growth(gpu, True)
+            except RuntimeError as e:
+                print(e)
+
+        # train in float16 on the GPU tensor cores, the variables stay float32
+        mixed_precision = bool(gpus) and ARGS.train_autoencoder
+        if mixed_precision:
+            tf.keras.mixed_precision.set_global_policy("mixed_float16")
+
+        # features are stored as rows, the transposed memmap is a patient-major view
+        # that is only read from disk once the training data is built
+        omics_data = load_float32_csv(ARGS.omics_data, mmap_mode="r").T
+        (num_patients, num_features) = omics_data.shape
+        print(
+            "{} contains {} patients with {} features".format(
+                ARGS.omics_data.split("/")[-1], num_patients, num_features
+            )
         )
-    else:
-        sys.exit("Wrong model for autoencoder!")
 
-    if ARGS.load_autoencoder is not None:
-        autoencoder.load_weights(ARGS.load_autoencoder).expect_partial()
+        # mirror the autoencoder variables on every visible GPU
+        strategy = tf.distribute.MirroredStrategy()
+        with strategy.scope():
+            if ARGS.autoencoder_model == "vanilla":
+                autoencoder = vanilla_autoencoder(
+                    latent_dim=hp.latent_dim,
+                    intermediate_dim=hp.intermediate_dim,
+                    original_dim=num_features,
+                )
+            elif ARGS.autoencoder_model == "convolutional":
+                autoencoder = convolutional_autoencoder(
+                    latent_dim=hp.latent_dim, original_dim=num_features,
+                )
+            elif ARGS.autoencoder_model == "variational":
+                autoencoder = variational_autoencoder(
+                    original_dim=num_features,
+                    intermediate_dim=hp.intermediate_dim,
+                    latent_dim=hp.latent_dim,
+                )
+            else:
+                sys.exit("Wrong model for autoencoder!")
+
+        if ARGS.load_autoencoder is not None:
+            autoencoder.load_weights(ARGS.load_autoencoder).expect_partial()
 
     if ARGS.train_autoencoder:
         print("===== Train autoencoder =====")
-        tf.convert_to_tensor(omics_data)
-        omics_data = tf.expand_dims(omics_data, axis=1)
+        if ARGS.autoencoder_model == "convolutional":
+            omics_data = tf.expand_dims(omics_data, axis=1)
+        # the sliced tensor already holds every row in memory, so the pipeline
+        # does not cache a second copy
         training_dataset = tf.data.Dataset.from_tensor_slices(omics_data)
+        training_dataset = training_dataset.shuffle(
+            num_patients, reshuffle_each_iteration=True
+        )
         training_dataset = training_dataset.batch(hp.batch_size)
-        training_dataset = training_dataset.shuffle(num_patients)
-        training_dataset = training_dataset.prefetch(hp.batch_size * 4)
-
-        optimizer = tf.keras.optimizers.Adam(
-            (
-                tf.keras.optimizers.schedules.InverseTimeDecay(
-                    hp.learning_rate, decay_steps=1, decay_rate=5e-5
-                )
-            )
+        # the autoencoder reconstructs its own input
+        training_dataset = training_dataset.map(
+            lambda batch: (batch, batch), num_parallel_calls=tf.data.AUTOTUNE
         )
-
-        train_loss = tf.keras.metrics.Mean("train_loss", dtype=tf.float32)
-
-        for epoch in range(hp.num_epochs):
-            for step, batch_features in enumerate(training_dataset):
-                autoencoder_train(
-                    autoencoder_loss_fn,
-                    autoencoder,
-                    optimizer,
-                    batch_features,
-                    train_loss,
-                )
-            tf.summary.scalar("loss", train_loss.result(), step=epoch)
-            if not ARGS.no_save:
-                save_name = "epoch_{}".format(epoch)
-                autoencoder.save_weights(
-                    filepath=checkpoint_path + os.sep + save_name, save_format="tf"
+        training_dataset = training_dataset.prefetch(tf.data.AUTOTUNE)
+
+        with strategy.scope():
+            optimizer = tf.keras.optimizers.Adam(
+                (
+                    tf.keras.optimizers.schedules.InverseTimeDecay(
+                        hp.learning_rate, decay_steps=1, decay_rate=5e-5
+                    )
                 )
-            template = "Epoch {}, Loss {:.8f}"
-            tf.print(
-                template.format(epoch + 1, train_loss.result()),
-                output_stream="file://{}/loss.log".format(logs_path),
             )
-            print(template.format(epoch + 1, train_loss.result()))
-            train_loss.reset_states()
+            if mixed_precision:
+                # scale the loss so small float16 gradients do not underflow
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+            autoencoder.compile(
+                optimizer=optimizer,
+                loss=autoencoder_loss_fn,
+                steps_per_execution=hp.steps_per_execution,
+            )
+
+        callbacks = [
+            tf.keras.callbacks.TensorBoard(
+                log_dir=logs_path, update_freq="epoch", profile_batch=0
+            ),
+            tf.keras.callbacks.CSVLogger(logs_path + os.sep + "loss.log"),
+        ]
+        if not ARGS.no_save:
+            callbacks.append(CustomModelSaver(checkpoint_path))
+
+        autoencoder.fit(
+            training_dataset, epochs=hp.num_epochs, callbacks=callbacks, verbose=2
+        )
 
     if ARGS.train_classifier:
+        from sklearn.model_selection import train_test_split
+
         print("===== train classifier =====")
         print("===== classifier preprocess =====")
         # biomed_df = pd.read_csv(ARGS.biomed_data, index_col=0)
@@ -255,36 +321,24 @@ def main():
             biomed_df = pd.read_csv(ARGS.biomed_data, index_col=0)
             num_biomed_features = biomed_df.shape[1] - 1
 
-            merged_df = pd.read_csv(ARGS.merged_data, index_col=0).astype("float32")
+            merged_data = load_float32_csv(ARGS.merged_data)
 
             print(
                 "{} contains {} patients with {} features".format(
                     ARGS.merged_data.split("/")[-1],
-                    merged_df.shape[0],
-                    merged_df.shape[1] - 1,
+                    merged_data.shape[0],
+                    merged_data.shape[1] - 1,
                 )
             )
-            X, Y = merged_df.iloc[:, :-1], merged_df.iloc[:, -1]
-            tf.convert_to_tensor(X)
-            tf.convert_to_tensor(Y)
-            X = tf.expand_dims(X, axis=1)
-            Y = tf.expand_dims(Y, axis=1)
-
-            X_omics = X[:, :, :-num_biomed_features]
-            X_biomed = X[:, :, -num_biomed_features:]
-            if ARGS.autoencoder_model == "variational":
-                X_omics = autoencoder.encoder(X_omics)[-1]
-            else:
-                X_omics = autoencoder.encoder(X_omics)
-            X_encoded = X_omics.numpy().reshape(-1, hp.latent_dim)
-            np.savetxt("latent_features.csv", X_encoded, delimiter=",")
+            X, Y = merged_data[:, :-1], merged_data[:, -1]
+
+            X_omics = X[:, :-num_biomed_features]
+            X_biomed = X[:, -num_biomed_features:]
+            X_omics = encode_omics(autoencoder, X_omics)
+            np.savetxt("latent_features.csv", X_omics, delimiter=",")
 
             print("===== finish omics encoding =====")
-            X = tf.concat([X_omics, X_biomed], axis=2)
-            X, Y = (
-                X.numpy().reshape(-1, hp.latent_dim + num_biomed_features),
-                Y.numpy().reshape(-1,),
-            )
+            X = np.concatenate([X_omics, X_biomed], axis=1)
         elif ARGS.classifier_data == "biomed":
             """ This use the unmerged biomed data for classifier
 
@@ -307,82 +361,63 @@ def main():
             biomed_df = pd.read_csv(ARGS.biomed_data, index_col=0)
             num_biomed_features = biomed_df.shape[1] - 1
 
-            merged_df = pd.read_csv(ARGS.merged_data, index_col=0).astype("float32")
+            merged_data = load_float32_csv(ARGS.merged_data)
 
             print(
                 "{} contains biomed data for {} patients with {} features".format(
                     ARGS.merged_data.split("/")[-1],
-                    merged_df.shape[0],
+                    merged_data.shape[0],
                     num_biomed_features,
                 )
             )
 
-            X, Y = merged_df.iloc[:, :-1], merged_df.iloc[:, -1]
-            tf.convert_to_tensor(X)
-            tf.convert_to_tensor(Y)
-            X = tf.expand_dims(X, axis=1)
-            Y = tf.expand_dims(Y, axis=1)
-
-            X_biomed = X[:, :, -num_biomed_features:]
-
             X, Y = (
-                X_biomed.numpy().reshape(-1, num_biomed_features),
-                Y.numpy().reshape(-1,),
+                merged_data[:, -1 - num_biomed_features : -1],
+                merged_data[:, -1],
             )
 
         elif ARGS.classifier_data == "omics":
             biomed_df = pd.read_csv(ARGS.biomed_data, index_col=0)
             num_biomed_features = biomed_df.shape[1] - 1
 
-            merged_df = pd.read_csv(ARGS.merged_data, index_col=0).astype("float32")
+            merged_data = load_float32_csv(ARGS.merged_data)
 
             print(
                 "{} contains omics data for {} patients with {} features".format(
                     ARGS.merged_data.split("/")[-1],
-                    merged_df.shape[0],
-                    merged_df.shape[1] - 1 - num_biomed_features,
+                    merged_data.shape[0],
+                    merged_data.shape[1] - 1 - num_biomed_features,
                 )
             )
 
             X, Y = (
-                merged_df.iloc[:, : -1 - num_biomed_features].to_numpy(),
-                merged_df.iloc[:, -1].to_numpy(),
+                merged_data[:, : -1 - num_biomed_features],
+                merged_data[:, -1],
             )
 
         elif ARGS.classifier_data == "embed_omics":
             biomed_df = pd.read_csv(ARGS.biomed_data, index_col=0)
             num_biomed_features = biomed_df.shape[1] - 1
 
-            merged_df = pd.read_csv(ARGS.merged_data, index_col=0).astype("float32")
+            merged_data = load_float32_csv(ARGS.merged_data)
 
             print(
                 "{} contains omics data for {} patients with {} features".format(
                     ARGS.merged_data.split("/")[-1],
-                    merged_df.shape[0],
-                    merged_df.shape[1] - 1 - num_biomed_features,
+                    merged_data.shape[0],
+                    merged_data.shape[1] - 1 - num_biomed_features,
                 )
             )
 
-            X, Y = merged_df.iloc[:, :-1], merged_df.iloc[:, -1]
-            tf.convert_to_tensor(X)
-            tf.convert_to_tensor(Y)
-            X = tf.expand_dims(X, axis=1)
-            Y = tf.expand_dims(Y, axis=1)
-
-            X_omics = X[:, :, :-num_biomed_features]
-            if ARGS.autoencoder_model == "variational":
-                X_omics = autoencoder.encoder(X_omics)[-1]
-            else:
-                X_omics = autoencoder.encoder(X_omics)
+            X_omics, Y = (
+                merged_data[:, : -1 - num_biomed_features],
+                merged_data[:, -1],
+            )
 
-            X_encoded = X_omics.numpy().reshape(-1, hp.latent_dim)
-            print(X_encoded.shape)
-            np.savetxt("latent_features.csv", X_encoded, delimiter=",")
+            X = encode_omics(autoencoder, X_omics)
+            print(X.shape)
+            np.savetxt("latent_features.csv", X, delimiter=",")
             print("===== finish omics encoding =====")
-            X, Y = (
-                X_omics.numpy().reshape(-1, hp.latent_dim),
-                Y.numpy().reshape(-1,),
-            )
         else:
             sys.exit("wrong classifier data!")
 
@@ -396,34 +431,51 @@ def main():
         )
         if ARGS.classifier_model == "vanilla_nn":
             sys.exit("Not finished!")
+            from classifiers import vanilla_classifier
+
             classifier = vanilla_classifier(input_shape=[hp.intermediate_dim])
 
         elif ARGS.classifier_model == "all":
-            print("===== start XGB =====")
-            xgb = XGBClassifier(random_state=42)
-            xgb.fit(X_train, y_train)
-
-            print("===== start RandomForest =====")
-            forest = RandomForestClassifier(random_state=42)
-            forest.fit(X_train, y_train)
-
-            print("===== start LogisticRegression =====")
-            logreg = LogisticRegression(random_state=42)
-            logreg.fit(X_train, y_train)
-
-            print("===== start SVC =====")
-            svc = SVC(random_state=42)
-            svc.fit(X_train, y_train)
+            import joblib
+            import matplotlib
+            import matplotlib.pyplot as plt
+            from xgboost import XGBClassifier
+            from sklearn.ensemble import RandomForestClassifier
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.svm import LinearSVC
+            from sklearn.metrics import roc_curve, auc, RocCurveDisplay
+
+            print("===== start XGB, RandomForest, LogisticRegression, SVC =====")
+            estimators = [
+                XGBClassifier(
+                    random_state=42, **xgb_device_params(gpus, use_autoencoder)
+                ),
+                RandomForestClassifier(random_state=42, n_jobs=-1),
+                LogisticRegression(random_state=42, n_jobs=-1, solver="lbfgs"),
+                LinearSVC(random_state=42),
+            ]
+            # the four models are independent, fit them in separate processes
+            xgb, forest, logreg, svc = joblib.Parallel(n_jobs=4, backend="loky")(
+                joblib.delayed(fit_classifier)(estimator, X_train, y_train)
+                for estimator in estimators
+            )
 
             print("===== start plotting results =====")
 
             font = {"weight": "bold", "size": 10}
             matplotlib.rc("font", **font)
 
-            xgb_disp = plot_roc_curve(xgb, X_test, y_test)
-            forest_disp = plot_roc_curve(forest, X_test, y_test, ax=xgb_disp.ax_)
-            logreg_disp = plot_roc_curve(logreg, X_test, y_test, ax=xgb_disp.ax_)
-            svc_disp = plot_roc_curve(svc, X_test, y_test, ax=xgb_disp.ax_)
+            _, ax = plt.subplots()
+            for estimator in (xgb, forest, logreg, svc):
+                # score the test set once per model and draw the curve from it
+                y_score = classifier_scores(estimator, X_test)
+                fpr, tpr, _ = roc_curve(y_test, y_score)
+                RocCurveDisplay(
+                    fpr=fpr,
+                    tpr=tpr,
+                    roc_auc=auc(fpr, tpr),
+                    estimator_name=estimator.__class__.__name__,
+                ).plot(ax=ax)
 
             print("Acc for XGBoost: {:.2f}".format(xgb.score(X_test, y_test)))
             print("Acc for RandomForest: {:.2f}".format(forest.score(X_test, y_test)))
@@ -449,8 +501,15 @@ def main():
 
         elif ARGS.classifier_model == "all_optimization":
             sys.exit("Not finished!")
+            import matplotlib.pyplot as plt
+            from xgboost import XGBClassifier
+            from sklearn.ensemble import RandomForestClassifier
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.model_selection import StratifiedKFold
+            from sklearn.metrics import roc_curve, roc_auc_score
+
             print("===== start xgb optimization =====")
-            xgb = XGBClassifier()
+            xgb = XGBClassifier(**xgb_device_params(gpus, use_autoencoder))
             hyparams_xgb = dict(
                 booster=["gbtree", "gblinear", "dart"],
                 eta=np.linspace(0, 1),
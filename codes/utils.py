@@ -4,10 +4,75 @@ import glob
 import os
 from datetime import datetime
 import json
+import hashlib
+import shutil
+import subprocess
 
 # merge(), uuid2barcode(), reindex()
 
 
+def has_cuda_gpu():
+    # ask the driver directly, without importing tensorflow just to find a device
+    if os.environ.get("CUDA_VISIBLE_DEVICES") in ("", "-1"):
+        return False
+    if shutil.which("nvidia-smi") is None:
+        return False
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "-L"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            timeout=10,
+        ).stdout
+    except (subprocess.SubprocessError, OSError):
+        return False
+    return b"GPU" in output
+
+
+def read_float32_csv(path):
+    # parse the values straight into float32 instead of float64 + astype
+    columns = pd.read_csv(path, index_col=0, nrows=0).columns
+    return pd.read_csv(
+        path, index_col=0, dtype=dict.fromkeys(columns, np.float32), engine="c"
+    )
+
+
+def save_npy(path, array):
+    # write next to the target and rename, so an interrupted run never leaves a
+    # truncated .npy behind that looks newer than its source
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+def load_float32_csv(path, mmap_mode=None):
+    # parse the csv once and reuse a binary copy of its values afterwards
+    npy_path = os.path.splitext(path)[0] + ".npy"
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(
+        path
+    ):
+        save_npy(npy_path, read_float32_csv(path).to_numpy())
+    return np.load(npy_path, mmap_mode=mmap_mode)
+
+
+def checkpoint_digest(checkpoint_path):
+    # a tf checkpoint is a prefix shared by several files, a SavedModel is a folder
+    if os.path.isdir(checkpoint_path):
+        files = glob.glob(os.path.join(checkpoint_path, "**"), recursive=True)
+    else:
+        files = glob.glob(checkpoint_path + ".*")
+
+    sha1 = hashlib.sha1()
+    for f in sorted(files):
+        if os.path.isfile(f):
+            with open(f, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    sha1.update(chunk)
+    return sha1.hexdigest()[:12]
+
+
 def merge_omics_biomed(omic_df, biomed_df, uuid2barcode, merged_name):
     (num_patients, num_features) = omic_df.shape
     print(